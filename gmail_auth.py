@@ -1,6 +1,11 @@
 import os
+import sys
+import json
 import logging
 import socket
+import threading
+import time
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 from urllib.parse import urlparse, parse_qs
 
@@ -9,11 +14,20 @@ socket.setdefaulttimeout(600)
 
 # Google Auth knihovny
 from google.oauth2.credentials import Credentials
+from google.auth.credentials import AnonymousCredentials
+from google.auth.exceptions import RefreshError
+from google.auth._helpers import REFRESH_THRESHOLD
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.http import HttpRequest, build_http
 import dotenv
 
+from gmail_config import env_number
+from gmail_profiling import PROFILE_ENABLED, TracedHttpRequest, span
+from gmail_replay import RecordingHttp, get_log_path, get_replay_http, get_transport_mode
+
 dotenv.load_dotenv()
 
 SCOPES = [
@@ -22,10 +36,12 @@ SCOPES = [
     'https://www.googleapis.com/auth/gmail.compose'
 ]
 
-def get_gmail_service(log_level=logging.INFO):
-    """
-    Získá Gmail službu. Robustní verze s manuálním fallbackem a dlouhým timeoutem.
-    """
+# Nejkratší prodleva mezi pokusy o obnovu tokenu na pozadí (sekundy)
+MIN_REFRESH_INTERVAL = 30
+# Typická životnost access tokenu Googlu, dokud ji nezměříme při prvním refreshi (sekundy)
+DEFAULT_TOKEN_LIFETIME = 3600
+
+def _get_logger():
     # Nastavení loggeru
     logger = logging.getLogger("gmail_auth")
     logger.setLevel(logging.INFO)
@@ -34,17 +50,38 @@ def get_gmail_service(log_level=logging.INFO):
         formatter = logging.Formatter('%(levelname)s: %(message)s')
         ch.setFormatter(formatter)
         logger.addHandler(ch)
+    return logger
 
-    creds = None
-    script_dir = Path(__file__).parent
-    token_path = script_dir / "token.json"
+def _save_token(creds, token_path):
+    # Atomický zápis: souběžný čtenář nikdy neuvidí napůl zapsaný token.json
+    tmp_path = token_path.with_name(token_path.name + ".tmp")
+    with open(tmp_path, "w") as token:
+        token.write(creds.to_json())
+        token.flush()
+        os.fsync(token.fileno())
+    os.replace(tmp_path, token_path)
+
+def _is_interactive():
+    """Manuální OAuth flow jen při interaktivním terminálu (přepis přes GMAIL_INTERACTIVE_AUTH_env)."""
+    override = os.getenv("GMAIL_INTERACTIVE_AUTH_env")
+    if override is not None:
+        return override.lower() in ("1", "true", "yes")
+    # MCP server přes stdio má stdin jako rouru s JSON-RPC, input() by ho rozbil
+    return sys.stdin is not None and sys.stdin.isatty()
+
+def _load_credentials(token_path):
+    """
+    Načte credentials z ENV nebo token.json (bez refreshe).
+    Returns:
+        Dvojice (credentials nebo None, zda obnovený token ukládat do token.json)
+    """
+    logger = _get_logger()
 
     # --- Načtení ENV ---
     env_client_id = os.getenv("GOOGLE_CLIENT_ID_env")
     env_client_secret = os.getenv("GOOGLE_CLIENT_SECRET_env")
     env_refresh_token = os.getenv("GOOGLE_REFRESH_TOKEN_env")
-    env_creds_filename = os.getenv("GOOGLE_CREDENTIALS_NAME_env")
-    
+
     # 1. Environment variables
     if env_client_id and env_client_secret and env_refresh_token:
         logger.info("🔑 Používám credentials z ENV.")
@@ -56,95 +93,277 @@ def get_gmail_service(log_level=logging.INFO):
             client_secret=env_client_secret,
             scopes=SCOPES
         )
+        return creds, False
 
     # 2. Existující token.json
-    elif token_path.exists():
+    if token_path.exists():
         logger.info(f"📂 Načítám existující token: {token_path}")
         try:
-            creds = Credentials.from_authorized_user_file(str(token_path), SCOPES)
+            return Credentials.from_authorized_user_file(str(token_path), SCOPES), True
         except Exception as e:
             logger.warning(f"Token soubor je poškozený: {e}")
 
-    # 3. Refresh
-    if creds and not creds.valid:
-        if creds.expired and creds.refresh_token:
-            logger.info("⟳ Token expiroval, provádím refresh...")
-            try:
-                creds.refresh(Request())
-            except Exception:
-                logger.warning("Refresh selhal.")
-                creds = None
-
-    # 4. Manuální autorizace (Copy-Paste)
-    if not creds:
-        logger.info("🌐 Spouštím manuální OAuth flow...")
-
-        # Konfigurace Flow
-        if env_client_id and env_client_secret:
-            config = {
-                "installed": {
-                    "client_id": env_client_id,
-                    "client_secret": env_client_secret,
-                    "auth_uri": "https://accounts.google.com/o/oauth2/auth",
-                    "token_uri": "https://oauth2.googleapis.com/token",
-                    "redirect_uris": ["http://localhost:8080/"]
-                }
+    return None, True
+
+def _run_manual_flow(token_path):
+    """Manuální autorizace (Copy-Paste). V neinteraktivním režimu rovnou selže."""
+    logger = _get_logger()
+    script_dir = Path(__file__).parent
+    env_client_id = os.getenv("GOOGLE_CLIENT_ID_env")
+    env_client_secret = os.getenv("GOOGLE_CLIENT_SECRET_env")
+    env_creds_filename = os.getenv("GOOGLE_CREDENTIALS_NAME_env")
+
+    if not _is_interactive():
+        raise RuntimeError(
+            "❌ Chybí platné Gmail credentials a manuální OAuth flow nelze spustit v neinteraktivním "
+            "režimu. Spusťte 'python generate_token.py' nebo nastavte GOOGLE_CLIENT_ID_env, "
+            "GOOGLE_CLIENT_SECRET_env a GOOGLE_REFRESH_TOKEN_env."
+        )
+
+    logger.info("🌐 Spouštím manuální OAuth flow...")
+
+    # Konfigurace Flow
+    if env_client_id and env_client_secret:
+        config = {
+            "installed": {
+                "client_id": env_client_id,
+                "client_secret": env_client_secret,
+                "auth_uri": "https://accounts.google.com/o/oauth2/auth",
+                "token_uri": "https://oauth2.googleapis.com/token",
+                "redirect_uris": ["http://localhost:8080/"]
             }
-            flow = InstalledAppFlow.from_client_config(config, SCOPES)
-        else:
-            secret_file = None
-            if env_creds_filename and (script_dir / env_creds_filename).exists():
-                secret_file = script_dir / env_creds_filename
-            elif list(script_dir.glob("client_secret_*.json")):
-                secret_file = list(script_dir.glob("client_secret_*.json"))[0]
-            
-            if not secret_file:
-                raise FileNotFoundError("❌ Chybí credentials.")
-            
-            logger.info(f"Používám soubor: {secret_file.name}")
-            flow = InstalledAppFlow.from_client_secrets_file(str(secret_file), SCOPES)
+        }
+        flow = InstalledAppFlow.from_client_config(config, SCOPES)
+    else:
+        secret_file = None
+        if env_creds_filename and (script_dir / env_creds_filename).exists():
+            secret_file = script_dir / env_creds_filename
+        elif list(script_dir.glob("client_secret_*.json")):
+            secret_file = list(script_dir.glob("client_secret_*.json"))[0]
+        
+        if not secret_file:
+            raise FileNotFoundError("❌ Chybí credentials.")
+        
+        logger.info(f"Používám soubor: {secret_file.name}")
+        flow = InstalledAppFlow.from_client_secrets_file(str(secret_file), SCOPES)
 
-        flow.redirect_uri = "http://localhost:8080/"
-        auth_url, _ = flow.authorization_url(prompt='consent', access_type='offline')
+    flow.redirect_uri = "http://localhost:8080/"
+    auth_url, _ = flow.authorization_url(prompt='consent', access_type='offline')
 
-        print("\n" + "="*80)
-        print("⚠️  MANUÁLNÍ AUTORIZACE:")
-        print(f"\n{auth_url}\n")
-        print("="*80 + "\n")
+    print("\n" + "="*80)
+    print("⚠️  MANUÁLNÍ AUTORIZACE:")
+    print(f"\n{auth_url}\n")
+    print("="*80 + "\n")
 
-        try:
-            auth_response = input("📝 Vložte zkopírovanou URL (http://localhost...) a dejte ENTER: ").strip()
-        except OSError:
-             logger.error("Nelze číst vstup. Spusťte skript interaktivně.")
-             raise
+    try:
+        auth_response = input("📝 Vložte zkopírovanou URL (http://localhost...) a dejte ENTER: ").strip()
+    except OSError:
+         logger.error("Nelze číst vstup. Spusťte skript interaktivně.")
+         raise
 
-        try:
-            parsed_url = urlparse(auth_response)
-            params = parse_qs(parsed_url.query)
-            
-            if 'code' not in params:
-                if auth_response.startswith("4/"):
-                    code = auth_response
-                else:
-                    raise ValueError("URL neobsahuje 'code'.")
+    try:
+        parsed_url = urlparse(auth_response)
+        params = parse_qs(parsed_url.query)
+        
+        if 'code' not in params:
+            if auth_response.startswith("4/"):
+                code = auth_response
             else:
-                code = params['code'][0]
+                raise ValueError("URL neobsahuje 'code'.")
+        else:
+            code = params['code'][0]
 
-            flow.fetch_token(code=code)
-            creds = flow.credentials
+        flow.fetch_token(code=code)
+        creds = flow.credentials
+        
+        logger.info("💾 Ukládám nový token do token.json")
+        _save_token(creds, token_path)
+        return creds
             
-            logger.info("💾 Ukládám nový token do token.json")
-            with open(token_path, "w") as token:
-                token.write(creds.to_json())
-                
+    except Exception as e:
+        logger.error(f"❌ Chyba: {e}")
+        raise
+
+class SharedCredentials(Credentials):
+    """
+    Credentials sdílené přes TokenManager. AuthorizedHttp volá refresh() sám
+    (těsně před vypršením tokenu a po odpovědi 401) – i takový refresh proto
+    projde zámkem manageru a souběžná vlákna token neobnovují každé zvlášť.
+    """
+    manager = None
+
+    def refresh(self, request):
+        if self.manager is None:
+            super().refresh(request)
+        else:
+            self.manager.refresh_shared(self)
+
+class TokenManager:
+    """
+    Drží jedny sdílené credentials pro celý proces.
+    Token obnovuje proaktivně ve vlákně na pozadí před vypršením; pokud ho
+    přesto potřebuje obnovit volající, proběhne refresh pod zámkem jen jednou
+    a ostatní souběžní volající na jeho výsledek počkají.
+    Args:
+        token_path: Cesta k token.json
+        refresh_margin: Kolik sekund před vypršením token obnovit (nejvýš polovina životnosti tokenu)
+    """
+    def __init__(self, token_path, refresh_margin=300):
+        self.token_path = Path(token_path)
+        self.refresh_margin = timedelta(seconds=refresh_margin)
+        self._lifetime = timedelta(seconds=DEFAULT_TOKEN_LIFETIME)
+        self._refreshed_at = None
+        self._creds = None
+        self._persist = True
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _margin(self):
+        # Okno delší než životnost tokenu by znamenalo refresh při každém volání;
+        # kratší než práh google-auth by nechalo refresh na AuthorizedHttp v každém vlákně
+        return max(min(self.refresh_margin, self._lifetime / 2), REFRESH_THRESHOLD)
+
+    def _share(self, creds):
+        # Refresh vyvolaný z AuthorizedHttp musí jít přes tento manager
+        if not isinstance(creds, SharedCredentials):
+            creds = SharedCredentials.from_authorized_user_info(json.loads(creds.to_json()))
+        creds.manager = self
+        return creds
+
+    def _needs_refresh(self, creds):
+        if not creds.valid:
+            return True
+        # google-auth drží expiry jako naivní UTC datetime
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        return creds.expiry is not None and creds.expiry - now < self._margin()
+
+    def _refresh(self):
+        logger = _get_logger()
+        logger.info("⟳ Obnovuji token...")
+        try:
+            with span("auth.refresh"):
+                Credentials.refresh(self._creds, Request())
         except Exception as e:
-            logger.error(f"❌ Chyba: {e}")
-            raise
+            logger.warning(f"Refresh selhal: {e}")
+            return False
+        if self._creds.expiry is not None:
+            now = datetime.now(timezone.utc).replace(tzinfo=None)
+            self._lifetime = max(self._creds.expiry - now, timedelta(seconds=2 * MIN_REFRESH_INTERVAL))
+        self._refreshed_at = time.monotonic()
+        if self._persist:
+            try:
+                _save_token(self._creds, self.token_path)
+            except OSError as e:
+                # Obnovený token v paměti platí dál, jen se nepodařilo ho uložit
+                logger.warning(f"Nelze uložit token do {self.token_path}: {e}")
+        return True
+
+    def refresh_shared(self, creds):
+        """Refresh vyžádaný z AuthorizedHttp; proběhne jen jednou, ostatní vlákna počkají na výsledek."""
+        with self._lock:
+            if creds is not self._creds:
+                # Zastaralý objekt, manager mezitím credentials nahradil
+                Credentials.refresh(creds, Request())
+                return
+            # Po 401 může být token podle expiry ještě platný; pokud ho ale právě
+            # obnovilo jiné vlákno, stačí požadavek zopakovat s novým tokenem
+            recently_refreshed = (
+                self._refreshed_at is not None and time.monotonic() - self._refreshed_at < MIN_REFRESH_INTERVAL
+            )
+            if self._creds.valid and recently_refreshed:
+                return
+            if not self._refresh():
+                raise RefreshError("Obnova Gmail tokenu selhala.")
+
+    def get_credentials(self):
+        """Vrátí platné credentials; při prvním volání je načte a spustí obnovu na pozadí."""
+        creds = self._creds
+        if creds is not None and not self._needs_refresh(creds):
+            return creds
 
-    logger.info("✅ Vytvářím Gmail API klienta.")
+        with self._lock:
+            # Mezitím mohl token obnovit jiný volající
+            if self._creds is None:
+                creds, self._persist = _load_credentials(self.token_path)
+                self._creds = self._share(creds) if creds is not None else None
+            if self._creds is not None and self._needs_refresh(self._creds):
+                if not self._refresh() and not self._creds.valid:
+                    self._creds = None
+            if self._creds is None:
+                self._creds = self._share(_run_manual_flow(self.token_path))
+                self._persist = True
+            self._start_background_refresh()
+            return self._creds
+
+    def _start_background_refresh(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._refresh_loop, name="gmail-token-refresh", daemon=True)
+            self._thread.start()
+
+    def _refresh_loop(self):
+        while True:
+            creds = self._creds
+            delay = MIN_REFRESH_INTERVAL
+            if creds is not None and creds.expiry is not None:
+                now = datetime.now(timezone.utc).replace(tzinfo=None)
+                delay = max((creds.expiry - now - self._margin()).total_seconds(), MIN_REFRESH_INTERVAL)
+            if self._stop.wait(delay):
+                return
+            with self._lock:
+                if self._creds is not None and self._needs_refresh(self._creds):
+                    self._refresh()
+
+    def stop(self):
+        """Ukončí vlákno s obnovou tokenu."""
+        self._stop.set()
+
+_REPLAY_CREDENTIALS = AnonymousCredentials()
+
+token_manager = TokenManager(
+    Path(__file__).parent / "token.json",
+    refresh_margin=env_number("GMAIL_TOKEN_REFRESH_MARGIN_env", 300),
+)
+
+def get_gmail_credentials(log_level=logging.INFO):
+    """
+    Získá OAuth credentials (ENV, token.json, refresh nebo manuální flow).
+    Credentials jsou sdílené v rámci procesu, viz TokenManager.
+    """
+    if get_transport_mode() == "replay":
+        # Přehrávání nepotřebuje přihlášení, sdílený objekt drží per-thread cache platnou
+        return _REPLAY_CREDENTIALS
+    with span("auth.get_credentials"):
+        return token_manager.get_credentials()
+
+def build_gmail_service(creds, http=None):
+    """
+    Postaví Gmail API klienta nad danými credentials.
+    Args:
+        creds: OAuth credentials
+        http: Volitelná vlastní httplib2.Http instance. Service objekty nejsou
+              thread-safe, každé vlákno proto potřebuje vlastní Http.
+    Při GMAIL_TRANSPORT_env=record/replay se komunikace zaznamenává, resp. přehrává (viz gmail_replay).
+    """
     # Zde se ještě nic neposílá po síti, jen se staví objekt
-    service = build("gmail", "v1", credentials=creds)
-    return service
+    request_builder = TracedHttpRequest if PROFILE_ENABLED else HttpRequest
+    transport_mode = get_transport_mode()
+    with span("discovery.build"):
+        if transport_mode == "replay":
+            return build("gmail", "v1", http=get_replay_http(), requestBuilder=request_builder)
+        if transport_mode == "record":
+            http = RecordingHttp(http or build_http(), get_log_path())
+        if http is not None:
+            return build("gmail", "v1", http=AuthorizedHttp(creds, http=http), requestBuilder=request_builder)
+        return build("gmail", "v1", credentials=creds, requestBuilder=request_builder)
+
+def get_gmail_service(log_level=logging.INFO):
+    """
+    Získá Gmail službu. Robustní verze s manuálním fallbackem a dlouhým timeoutem.
+    """
+    creds = get_gmail_credentials(log_level)
+    _get_logger().info("✅ Vytvářím Gmail API klienta.")
+    return build_gmail_service(creds)
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,72 @@
+"""
+LRU cache detailů zpráv (format='full') omezená velikostí v bajtech.
+Rozlišuje položky načtené dopředu (prefetch), aby šlo měřit úspěšnost read-ahead.
+"""
+import json
+import threading
+from collections import OrderedDict
+
+class MessageCache:
+    """
+    Args:
+        max_bytes: Celkový limit velikosti položek (odhad podle délky JSON)
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        # Bajty položek z prefetche, o které si zatím nikdo neřekl
+        self.prefetched_bytes = 0
+        # id -> [detail, velikost, načteno prefetchem a zatím nepoužito]
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "prefetched": 0,
+            "prefetch_hits": 0,
+            "prefetch_evicted_unused": 0,
+        }
+
+    def __contains__(self, message_id):
+        with self._lock:
+            return message_id in self._entries
+
+    def get(self, message_id):
+        """Vrátí detail zprávy z cache nebo None."""
+        with self._lock:
+            entry = self._entries.get(message_id)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(message_id)
+            self.stats["hits"] += 1
+            if entry[2]:
+                entry[2] = False
+                self.prefetched_bytes -= entry[1]
+                self.stats["prefetch_hits"] += 1
+            return entry[0]
+
+    def put(self, message_id, detail, prefetched=False):
+        """Uloží detail zprávy, případně vyhodí nejdéle nepoužité položky."""
+        size = len(json.dumps(detail))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if message_id in self._entries:
+                self._remove(message_id)
+            while self._entries and self.size + size > self.max_bytes:
+                evicted_id = next(iter(self._entries))
+                if self._entries[evicted_id][2]:
+                    self.stats["prefetch_evicted_unused"] += 1
+                self._remove(evicted_id)
+            self._entries[message_id] = [detail, size, prefetched]
+            self.size += size
+            if prefetched:
+                self.prefetched_bytes += size
+                self.stats["prefetched"] += 1
+
+    def _remove(self, message_id):
+        _, size, prefetched = self._entries.pop(message_id)
+        self.size -= size
+        if prefetched:
+            self.prefetched_bytes -= size
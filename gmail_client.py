@@ -1,12 +1,263 @@
 import base64
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from email.mime.text import MIMEText
 import logging
-from gmail_auth import get_gmail_service
+import httplib2
+from gmail_cache import MessageCache
+from gmail_config import env_number
+from gmail_auth import get_gmail_service, get_gmail_credentials, build_gmail_service
 from googleapiclient.errors import HttpError
+from gmail_profiling import span
+
+# Cena volání v jednotkách kvóty Gmail API (limit je 250 jednotek/s na uživatele)
+MESSAGES_LIST_UNITS = 5
+MESSAGES_GET_UNITS = 5
+MESSAGES_SEND_UNITS = 100
+DRAFTS_CREATE_UNITS = 10
+# Horní mez počtu vláken pro paralelní stahování detailů zpráv
+MAX_FETCH_WORKERS = 16
+# Hlavičky, které listovací funkce potřebují (stahují jen format='metadata')
+SUMMARY_HEADERS = ["Subject", "From"]
+# Read-ahead: kolik prvních zpráv z výpisu stáhnout dopředu (0 = vypnuto)
+PREFETCH_K = env_number("GMAIL_PREFETCH_K_env", 0)
+# Max. bajtů v cache obsazených dopředu staženými, zatím nepoužitými zprávami
+PREFETCH_MAX_BYTES = env_number("GMAIL_PREFETCH_MAX_BYTES_env", 10 * 1024 * 1024)
+# Prefetch se nespustí, pokud v limiteru zbývá méně jednotek kvóty
+PREFETCH_QUOTA_RESERVE = env_number("GMAIL_PREFETCH_QUOTA_RESERVE_env", 100.0, float)
+# Odhad velikosti typické zprávy (format='full' jako JSON); menší cache prefetch jen pálí kvótu
+TYPICAL_MESSAGE_BYTES = 50 * 1024
 
 def log(msg, level=logging.INFO):
     logging.log(level, msg)
 
+class QuotaLimiter:
+    """Token bucket sdílený všemi voláními Gmail API v procesu.
+    Args:
+        units_per_sec: Kolik jednotek kvóty se doplní za sekundu (0 = bez limitu)
+    """
+    def __init__(self, units_per_sec):
+        self.units_per_sec = units_per_sec
+        # Kapacita musí pojmout aspoň nejdražší volání, jinak by acquire čekal navždy
+        self.capacity = max(
+            units_per_sec, MESSAGES_LIST_UNITS, MESSAGES_GET_UNITS, MESSAGES_SEND_UNITS, DRAFTS_CREATE_UNITS
+        )
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.units_per_sec)
+        self._last = now
+
+    def available(self):
+        """Vrátí počet aktuálně dostupných jednotek kvóty."""
+        with self._lock:
+            self._refill()
+            return self._tokens
+
+    def acquire(self, units):
+        """Blokuje, dokud není k dispozici požadovaný počet jednotek."""
+        if self.units_per_sec <= 0:
+            return
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= units:
+                    self._tokens -= units
+                    return
+                wait = (units - self._tokens) / self.units_per_sec
+            with span("quota.wait"):
+                time.sleep(wait)
+
+quota_limiter = QuotaLimiter(env_number("GMAIL_QUOTA_UNITS_PER_SEC_env", 250.0, float))
+
+# Jeden pool pro každý počet vláken; pool, který může jiný volající právě používat, se nikdy nevyměňuje
+_executors = {}
+_executor_lock = threading.Lock()
+_thread_local = threading.local()
+
+def _get_fetch_workers():
+    """Počet vláken z GMAIL_FETCH_WORKERS_env (1 = sekvenční stahování)."""
+    workers = env_number("GMAIL_FETCH_WORKERS_env", 1)
+    return max(1, min(workers, MAX_FETCH_WORKERS))
+
+def _get_executor(workers):
+    with _executor_lock:
+        if workers not in _executors:
+            _executors[workers] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"gmail-fetch-{workers}")
+        return _executors[workers]
+
+def _get_thread_service(creds):
+    # googleapiclient service ani httplib2.Http nejsou thread-safe,
+    # každé vlákno si proto drží vlastní instanci
+    if getattr(_thread_local, "creds", None) is not creds:
+        _thread_local.service = build_gmail_service(creds, http=httplib2.Http())
+        _thread_local.creds = creds
+    return _thread_local.service
+
+def _get_message(service, message_id, **kwargs):
+    quota_limiter.acquire(MESSAGES_GET_UNITS)
+    return service.users().messages().get(userId="me", id=message_id, **kwargs).execute()
+
+def fetch_messages(creds, service, message_ids, workers=None, skip_missing=False, **kwargs):
+    """Stáhne detaily zpráv ve stejném pořadí, v jakém jsou zadána ID.
+    Při GMAIL_FETCH_WORKERS_env > 1 stahuje paralelně v ThreadPoolExecutoru.
+    Args:
+        creds: OAuth credentials (pro per-thread service instance)
+        service: Service pro sekvenční režim
+        message_ids: Seznam ID zpráv
+        workers: Počet vláken (výchozí z GMAIL_FETCH_WORKERS_env)
+        skip_missing: Zprávy smazané mezi list a get (404) vynechat místo vyhození HttpError
+        **kwargs: Další parametry pro messages().get (např. format)
+    Returns:
+        Seznam slovníků s detaily zpráv
+    """
+    def get(service, message_id):
+        try:
+            return _get_message(service, message_id, **kwargs)
+        except HttpError as error:
+            if skip_missing and error.resp.status == 404:
+                log(f"Zpráva {message_id} už neexistuje, přeskakuji.", logging.WARNING)
+                return None
+            raise
+
+    workers = max(1, min(workers, MAX_FETCH_WORKERS)) if workers else _get_fetch_workers()
+    if workers <= 1 or len(message_ids) <= 1:
+        details = [get(service, message_id) for message_id in message_ids]
+    else:
+        def fetch(message_id, context):
+            return context.run(lambda: get(_get_thread_service(creds), message_id))
+
+        # Každý úkol dostane kopii kontextu volajícího (kvůli trace v gmail_profiling);
+        # executor.map zachovává pořadí a první výjimku (HttpError) propaguje volajícímu
+        contexts = [contextvars.copy_context() for _ in message_ids]
+        details = list(_get_executor(workers).map(fetch, message_ids, contexts))
+    return [msg_detail for msg_detail in details if msg_detail is not None]
+
+message_cache = MessageCache(env_number("GMAIL_CACHE_MAX_BYTES_env", 50 * 1024 * 1024))
+prefetch_stats = {"scheduled": 0, "cancelled": 0, "skipped_budget": 0, "skipped_quota": 0, "failed": 0}
+_prefetch_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="gmail-prefetch")
+_prefetch_futures = {}
+_prefetch_lock = threading.Lock()
+
+def _count_prefetch(key):
+    with _prefetch_lock:
+        prefetch_stats[key] += 1
+
+def _prefetch_one(creds, message_id):
+    if message_id in message_cache:
+        return
+    # Rozhoduje se až při spuštění úkolu, mezitím se budget i kvóta mohly změnit
+    if message_cache.prefetched_bytes >= PREFETCH_MAX_BYTES:
+        _count_prefetch("skipped_budget")
+        return
+    # Bez limitu (0) se kvóta nehlídá; rezerva nad kapacitou bucketu by prefetch zakázala úplně
+    reserve = min(PREFETCH_QUOTA_RESERVE, quota_limiter.capacity)
+    if quota_limiter.units_per_sec > 0 and quota_limiter.available() < reserve:
+        _count_prefetch("skipped_quota")
+        return
+    try:
+        msg_detail = _get_message(_get_thread_service(creds), message_id, format="full")
+    except Exception as error:
+        _count_prefetch("failed")
+        log(f"Prefetch zprávy {message_id} selhal: {error}", logging.DEBUG)
+        return
+    message_cache.put(message_id, msg_detail, prefetched=True)
+
+def prefetch_message_details(message_ids, k=None):
+    """Na pozadí stáhne plné detaily prvních k zpráv z výpisu do message_cache.
+    Nevyřízené úkoly z předchozího výpisu se zruší (agent už pracuje s novým).
+    Args:
+        message_ids: ID zpráv v pořadí výpisu
+        k: Počet zpráv (výchozí GMAIL_PREFETCH_K_env)
+    """
+    k = PREFETCH_K if k is None else k
+    if k <= 0 or not message_ids or message_cache.max_bytes < TYPICAL_MESSAGE_BYTES:
+        return
+    creds = get_gmail_credentials()
+    with _prefetch_lock:
+        for message_id, future in list(_prefetch_futures.items()):
+            if future.cancel():
+                prefetch_stats["cancelled"] += 1
+            # Běžící úkoly zůstávají, get_message_detail na ně počká místo druhého stažení
+            if future.cancelled() or future.done():
+                del _prefetch_futures[message_id]
+        for message_id in message_ids[:k]:
+            if message_id in message_cache or message_id in _prefetch_futures:
+                continue
+            prefetch_stats["scheduled"] += 1
+            _prefetch_futures[message_id] = _prefetch_executor.submit(_prefetch_one, creds, message_id)
+
+def get_prefetch_stats():
+    """Vrátí statistiky cache a read-ahead (úspěšnost prefetche pro ladění k)."""
+    stats = dict(message_cache.stats, **prefetch_stats)
+    stats["prefetch_hit_rate"] = stats["prefetch_hits"] / stats["prefetched"] if stats["prefetched"] else 0.0
+    stats["cache_bytes"] = message_cache.size
+    stats["prefetched_unused_bytes"] = message_cache.prefetched_bytes
+    return stats
+
+def _summarize_message(msg_detail):
+    headers = msg_detail.get("payload", {}).get("headers", [])
+    subject = next((h["value"] for h in headers if h["name"] == "Subject"), "(bez předmětu)")
+    sender = next((h["value"] for h in headers if h["name"] == "From"), "(neznámý odesílatel)")
+    snippet = msg_detail.get("snippet", "")[:60]
+    return {"id": msg_detail["id"], "subject": subject, "from": sender, "snippet": snippet}
+
+def iter_message_pages(service, query='', page_token=None, page_size=500):
+    """Postupně prochází stránky výsledků messages().list.
+    Args:
+        service: Gmail service
+        query: Gmail query
+        page_token: Token stránky, od které začít (pro navázání)
+        page_size: Počet ID na stránku (max. 500)
+    Yields:
+        Dvojice (seznam ID zpráv na stránce, token této stránky)
+    """
+    while True:
+        quota_limiter.acquire(MESSAGES_LIST_UNITS)
+        response = service.users().messages().list(
+            userId="me", q=query, maxResults=page_size, pageToken=page_token
+        ).execute()
+        yield [msg["id"] for msg in response.get("messages", [])], page_token
+        page_token = response.get("nextPageToken")
+        if not page_token:
+            return
+
+def get_plain_text_body(msg_detail):
+    """Vrátí dekódovaný text/plain obsah zprávy načtené ve formátu 'full'.
+    Args:
+        msg_detail: Slovník s detailem zprávy z messages().get
+    Returns:
+        Text těla zprávy (prázdný řetězec, pokud žádná text/plain část není)
+    """
+    texts = []
+    stack = [msg_detail.get("payload", {})]
+    while stack:
+        part = stack.pop(0)
+        if part.get("mimeType") == "text/plain":
+            data = part.get("body", {}).get("data")
+            if data:
+                texts.append(base64.urlsafe_b64decode(data + "=" * (-len(data) % 4)).decode("utf-8", errors="replace"))
+        stack.extend(part.get("parts", []))
+    return "\n".join(texts)
+
+def _get_message_summaries(n, query, log_level=logging.INFO):
+    creds = get_gmail_credentials(log_level)
+    service = build_gmail_service(creds)
+    quota_limiter.acquire(MESSAGES_LIST_UNITS)
+    results = service.users().messages().list(userId="me", maxResults=n, q=query).execute()
+    messages = results.get("messages", [])
+    # Pro výpis stačí hlavičky a úryvek, plné tělo případně stáhne read-ahead
+    details = fetch_messages(
+        creds, service, [msg["id"] for msg in messages], format="metadata", metadataHeaders=SUMMARY_HEADERS
+    )
+    with span("summarize"):
+        return [_summarize_message(msg_detail) for msg_detail in details]
+
 def ListMessages(service, user, query='', log_level=logging.INFO):
         """Gets a list of messages.
 
@@ -22,6 +273,7 @@ def ListMessages(service, user, query='', log_level=logging.INFO):
                 appropriate id to get the details of a Message.
         """
         try:
+                quota_limiter.acquire(MESSAGES_LIST_UNITS)
                 response = service.users().messages().list(userId=user, q=query).execute()
                 messages = []
                 if 'messages' in response:
@@ -29,6 +281,7 @@ def ListMessages(service, user, query='', log_level=logging.INFO):
 
                 while 'nextPageToken' in response:
                         page_token = response['nextPageToken']
+                        quota_limiter.acquire(MESSAGES_LIST_UNITS)
                         response = service.users().messages().list(userId=user, q=query, pageToken=page_token).execute()
                         if 'messages' in response:
                                 messages.extend(response['messages'])
@@ -53,7 +306,6 @@ def get_last_messages(n=5, status="all", after=None, before=None, log_level=logg
         Seznam slovníků: {'id': ..., 'subject': ..., 'from': ..., 'snippet': ...}
     """
     try:
-        service = get_gmail_service(log_level)
         query_parts = []
         if status == "unread":
             query_parts.append("is:unread")
@@ -67,16 +319,7 @@ def get_last_messages(n=5, status="all", after=None, before=None, log_level=logg
             query_parts.append(f"before:{before.replace('/', '')}")
 
         query = " ".join(query_parts)
-        results = service.users().messages().list(userId="me", maxResults=n, q=query).execute()
-        messages = results.get("messages", [])
-        output = []
-        for msg in messages:
-            msg_detail = service.users().messages().get(userId="me", id=msg["id"]).execute()
-            headers = msg_detail.get("payload", {}).get("headers", [])
-            subject = next((h["value"] for h in headers if h["name"] == "Subject"), "(bez předmětu)")
-            sender = next((h["value"] for h in headers if h["name"] == "From"), "(neznámý odesílatel)")
-            snippet = msg_detail.get("snippet", "")[:60]
-            output.append({"id": msg["id"], "subject": subject, "from": sender, "snippet": snippet})
+        output = _get_message_summaries(n, query, log_level)
         log(f"Načteno {len(output)} zpráv.", log_level)
         return output
     except HttpError as error:
@@ -90,9 +333,19 @@ def get_message_detail(message_id, log_level=logging.INFO):
     Returns:
         Slovník s detaily zprávy nebo None při chybě
     """
+    with _prefetch_lock:
+        future = _prefetch_futures.get(message_id)
+    if future is not None and future.running():
+        # Zpráva se právě stahuje dopředu, nemá smysl ji stahovat podruhé
+        future.result()
+    msg_detail = message_cache.get(message_id)
+    if msg_detail is not None:
+        log(f"Detail zprávy ID: {message_id} z cache", log_level)
+        return msg_detail
     try:
         service = get_gmail_service(log_level)
-        msg_detail = service.users().messages().get(userId="me", id=message_id, format="full").execute()
+        msg_detail = _get_message(service, message_id, format="full")
+        message_cache.put(message_id, msg_detail)
         log(f"Načteny detaily zprávy ID: {message_id}", log_level)
         return msg_detail
     except HttpError as error:
@@ -116,6 +369,7 @@ def send_mail(subject, message_text, to, log_level=logging.INFO):
         mime_message['subject'] = subject
         raw = base64.urlsafe_b64encode(mime_message.as_bytes()).decode()
         body = {'raw': raw}
+        quota_limiter.acquire(MESSAGES_SEND_UNITS)
         sent_message = service.users().messages().send(userId="me", body=body).execute()
         log(f"Zpráva odeslána, ID: {sent_message['id']}")
         return sent_message['id']
@@ -140,6 +394,7 @@ def create_draft(subject, message_text, to, log_level=logging.INFO):
         mime_message['subject'] = subject
         raw = base64.urlsafe_b64encode(mime_message.as_bytes()).decode()
         body = {'message': {'raw': raw}}
+        quota_limiter.acquire(DRAFTS_CREATE_UNITS)
         draft = service.users().drafts().create(userId="me", body=body).execute()
         log(f"Koncept vytvořen, ID: {draft['id']}")
         return draft['id']
@@ -159,23 +414,13 @@ def get_messages_from_sender(sender_email, n=100, after=None, before=None, log_l
         Seznam slovníků: {'id': ..., 'subject': ..., 'from': ..., 'snippet': ...}
     """
     try:
-        service = get_gmail_service(log_level)
         query_parts = [f'from:{sender_email}']
         if after:
             query_parts.append(f"after:{after.replace('/', '')}")
         if before:
             query_parts.append(f"before:{before.replace('/', '')}")
         query = " ".join(query_parts)
-        results = service.users().messages().list(userId="me", maxResults=n, q=query).execute()
-        messages = results.get("messages", [])
-        output = []
-        for msg in messages:
-            msg_detail = service.users().messages().get(userId="me", id=msg["id"]).execute()
-            headers = msg_detail.get("payload", {}).get("headers", [])
-            subject = next((h["value"] for h in headers if h["name"] == "Subject"), "(bez předmětu)")
-            sender = next((h["value"] for h in headers if h["name"] == "From"), "(neznámý odesílatel)")
-            snippet = msg_detail.get("snippet", "")[:60]
-            output.append({"id": msg["id"], "subject": subject, "from": sender, "snippet": snippet})
+        output = _get_message_summaries(n, query, log_level)
         log(f"Načteno {len(output)} zpráv od {sender_email}.", log_level)
         return output
     except HttpError as error:
@@ -194,23 +439,13 @@ def get_messages_by_subject(subject_text, n=100, after=None, before=None, log_le
         Seznam slovníků: {'id': ..., 'subject': ..., 'from': ..., 'snippet': ...}
     """
     try:
-        service = get_gmail_service(log_level)
         query_parts = [f'subject:{subject_text}']
         if after:
             query_parts.append(f"after:{after.replace('/', '')}")
         if before:
             query_parts.append(f"before:{before.replace('/', '')}")
         query = " ".join(query_parts)
-        results = service.users().messages().list(userId="me", maxResults=n, q=query).execute()
-        messages = results.get("messages", [])
-        output = []
-        for msg in messages:
-            msg_detail = service.users().messages().get(userId="me", id=msg["id"]).execute()
-            headers = msg_detail.get("payload", {}).get("headers", [])
-            subject = next((h["value"] for h in headers if h["name"] == "Subject"), "(bez předmětu)")
-            sender = next((h["value"] for h in headers if h["name"] == "From"), "(neznámý odesílatel)")
-            snippet = msg_detail.get("snippet", "")[:60]
-            output.append({"id": msg["id"], "subject": subject, "from": sender, "snippet": snippet})
+        output = _get_message_summaries(n, query, log_level)
         log(f"Načteno {len(output)} zpráv s předmětem obsahujícím '{subject_text}'.", log_level)
         return output
     except HttpError as error:
@@ -229,23 +464,13 @@ def get_messages_by_body(body_text, n=100, after=None, before=None, log_level=lo
         Seznam slovníků: {'id': ..., 'subject': ..., 'from': ..., 'snippet': ...}
     """
     try:
-        service = get_gmail_service(log_level)
         query_parts = [body_text]
         if after:
             query_parts.append(f"after:{after.replace('/', '')}")
         if before:
             query_parts.append(f"before:{before.replace('/', '')}")
         query = " ".join(query_parts)
-        results = service.users().messages().list(userId="me", maxResults=n, q=query).execute()
-        messages = results.get("messages", [])
-        output = []
-        for msg in messages:
-            msg_detail = service.users().messages().get(userId="me", id=msg["id"]).execute()
-            headers = msg_detail.get("payload", {}).get("headers", [])
-            subject = next((h["value"] for h in headers if h["name"] == "Subject"), "(bez předmětu)")
-            sender = next((h["value"] for h in headers if h["name"] == "From"), "(neznámý odesílatel)")
-            snippet = msg_detail.get("snippet", "")[:60]
-            output.append({"id": msg["id"], "subject": subject, "from": sender, "snippet": snippet})
+        output = _get_message_summaries(n, query, log_level)
         log(f"Načteno {len(output)} zpráv s obsahem '{body_text}'.", log_level)
         return output
     except HttpError as error:
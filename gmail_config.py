@@ -0,0 +1,19 @@
+"""
+Načítání číselných nastavení z ENV.
+Neplatná hodnota nesmí shodit import (a tím celý MCP server),
+místo toho se zaloguje varování a použije výchozí hodnota.
+"""
+import logging
+import os
+
+def env_number(name, default, cast=int):
+    """Vrátí hodnotu proměnné prostředí převedenou přes cast, při chybě default."""
+    value = os.getenv(name)
+    if value is None or not value.strip():
+        return default
+    try:
+        return cast(value)
+    except ValueError:
+        # Vlastní logger: logging.warning() na rootu by implicitně volal basicConfig
+        logging.getLogger("gmail_config").warning(f"Neplatná hodnota {name}={value!r}, používám {default}.")
+        return default
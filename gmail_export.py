@@ -0,0 +1,246 @@
+"""
+Hromadný export zpráv odpovídajících Gmail query do mbox nebo Parquet.
+Zprávy se stahují po dávkách (mbox format=raw, Parquet jen format=metadata),
+takže paměť zůstává omezená, a po každé dávce se ukládá checkpoint – přerušený
+export lze spustit znovu stejným příkazem a naváže tam, kde skončil.
+Existující výstup bez checkpointu se přepíše jen s --force.
+
+Použití:
+    python gmail_export.py "from:someone@example.com" export.mbox
+    python gmail_export.py "after:2024/01/01" export_dir --format parquet --workers 8
+
+Parquet export vyžaduje: pip install pyarrow
+"""
+import argparse
+import base64
+import json
+import logging
+import os
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+from gmail_auth import get_gmail_credentials, build_gmail_service
+from gmail_client import log, fetch_messages, iter_message_pages
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+DEFAULT_BATCH_SIZE = 100
+# Hlavičky, které Parquet export potřebuje (stačí format=metadata, bez těla a příloh)
+PARQUET_HEADERS = ["Subject", "From", "To", "Date"]
+
+class ExportCheckpoint:
+    """Stav exportu uložený vedle výstupu (<výstup>.checkpoint.json).
+    Pamatuje si token rozpracované stránky, ID z ní už zapsaná, velikost
+    mbox souboru a počet Parquet částí, aby navázání nic nezdvojilo.
+    """
+    def __init__(self, path, query, fmt):
+        self.path = Path(path)
+        self.state = {
+            "query": query,
+            "format": fmt,
+            "page_token": None,
+            "done_ids": [],
+            "exported": 0,
+            "offset": 0,
+            "parts": 0,
+            "complete": False,
+        }
+        if self.path.exists():
+            with open(self.path, encoding="utf-8") as f:
+                saved = json.load(f)
+            if saved.get("query") != query or saved.get("format") != fmt:
+                raise ValueError(
+                    f"Checkpoint {self.path} patří k jinému exportu "
+                    f"(query={saved.get('query')!r}, format={saved.get('format')!r})."
+                )
+            self.state.update(saved)
+
+    def __getitem__(self, key):
+        return self.state[key]
+
+    def save(self, **changes):
+        """Aktualizuje stav a atomicky ho zapíše na disk."""
+        self.state.update(changes)
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+def _decode_raw(msg):
+    raw = msg["raw"]
+    return base64.urlsafe_b64decode(raw + "=" * (-len(raw) % 4))
+
+class MboxWriter:
+    """Streamovaný zápis do mboxrd. Při navázání ořízne soubor na poslední checkpoint."""
+    def __init__(self, path, offset):
+        self.path = Path(path)
+        self.file = open(self.path, "ab")
+        self.file.truncate(offset)
+        self.file.seek(offset)
+
+    def write(self, messages):
+        for msg in messages:
+            received = datetime.fromtimestamp(int(msg.get("internalDate", 0)) / 1000, tz=timezone.utc)
+            self.file.write(f"From MAILER-DAEMON {received.strftime('%a %b %d %H:%M:%S %Y')}\n".encode())
+            for line in _decode_raw(msg).replace(b"\r\n", b"\n").split(b"\n"):
+                # mboxrd: řádky začínající (>*)From dostanou další '>'
+                if line.lstrip(b">").startswith(b"From "):
+                    line = b">" + line
+                self.file.write(line + b"\n")
+            self.file.write(b"\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def checkpoint_state(self):
+        return {"offset": self.file.tell()}
+
+    def close(self):
+        self.file.close()
+
+class ParquetWriter:
+    """Zapisuje metadata zpráv (format=metadata), každou dávku jako samostatný part-NNNNNN.parquet."""
+    def __init__(self, path, parts):
+        if pa is None:
+            raise ImportError("Parquet export vyžaduje: pip install pyarrow")
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.parts = parts
+        self.schema = pa.schema([
+            ("id", pa.string()), ("thread_id", pa.string()), ("label_ids", pa.list_(pa.string())),
+            ("internal_date", pa.timestamp("ms", tz="UTC")), ("size_estimate", pa.int64()),
+            ("subject", pa.string()), ("from", pa.string()), ("to", pa.string()),
+            ("date", pa.string()), ("snippet", pa.string()),
+        ])
+
+    def _row(self, msg):
+        # Gmail vrací hodnoty hlaviček už dekódované (RFC 2047, 8bit); velikost písmen v názvu se liší
+        headers = {h["name"].lower(): h["value"] for h in msg.get("payload", {}).get("headers", [])}
+        return {
+            "id": msg["id"],
+            "thread_id": msg.get("threadId"),
+            "label_ids": msg.get("labelIds", []),
+            "internal_date": int(msg.get("internalDate", 0)),
+            "size_estimate": msg.get("sizeEstimate"),
+            "subject": headers.get("subject"),
+            "from": headers.get("from"),
+            "to": headers.get("to"),
+            "date": headers.get("date"),
+            "snippet": msg.get("snippet"),
+        }
+
+    def write(self, messages):
+        table = pa.Table.from_pylist([self._row(msg) for msg in messages], schema=self.schema)
+        # Případná rozepsaná část z přerušeného běhu se prostě přepíše
+        pq.write_table(table, self.path / f"part-{self.parts:06d}.parquet")
+        self.parts += 1
+
+    def checkpoint_state(self):
+        return {"parts": self.parts}
+
+    def close(self):
+        pass
+
+def _existing_output(output, fmt):
+    # Prázdný adresář pro Parquet nevadí, přepsat by šly jen soubory part-*.parquet
+    if fmt == "parquet":
+        return sorted(output.glob("part-*.parquet")) if output.is_dir() else []
+    return [output] if output.exists() else []
+
+def export_messages(query, output, fmt="mbox", batch_size=DEFAULT_BATCH_SIZE, workers=None, force=False,
+                    log_level=logging.INFO):
+    """
+    Exportuje všechny zprávy odpovídající query do mbox souboru nebo adresáře s Parquet soubory.
+    Args:
+        query: Gmail query (prázdná = celá schránka)
+        output: Cesta k mbox souboru / adresáři pro Parquet
+        fmt: 'mbox' nebo 'parquet'
+        batch_size: Počet zpráv stahovaných a zapisovaných najednou
+        workers: Počet vláken pro stahování (výchozí z GMAIL_FETCH_WORKERS_env)
+        force: Přepsat existující výstup, ke kterému nepatří žádný checkpoint
+    Returns:
+        Celkový počet exportovaných zpráv
+    """
+    output = Path(output)
+    checkpoint_path = output.with_name(output.name + ".checkpoint.json")
+    existing = [] if checkpoint_path.exists() else _existing_output(output, fmt)
+    if existing and not force:
+        raise FileExistsError(
+            f"Výstup {output} už existuje a nepatří k němu checkpoint. "
+            "Zvolte jinou cestu, nebo ho přepište s --force."
+        )
+    for path in existing:
+        path.unlink()
+    checkpoint = ExportCheckpoint(checkpoint_path, query, fmt)
+    if checkpoint["complete"]:
+        log(f"Export do {output} je již dokončen ({checkpoint['exported']} zpráv).", log_level)
+        return checkpoint["exported"]
+    if checkpoint["exported"]:
+        log(f"Navazuji na přerušený export ({checkpoint['exported']} zpráv hotovo).", log_level)
+
+    creds = get_gmail_credentials(log_level)
+    service = build_gmail_service(creds)
+    if fmt == "mbox":
+        writer = MboxWriter(output, checkpoint["offset"])
+        fetch_kwargs = {"format": "raw"}
+    elif fmt == "parquet":
+        writer = ParquetWriter(output, checkpoint["parts"])
+        fetch_kwargs = {"format": "metadata", "metadataHeaders": PARQUET_HEADERS}
+    else:
+        raise ValueError(f"Neznámý formát exportu: {fmt}")
+
+    started = time.monotonic()
+    session_exported = 0
+    try:
+        done_ids = set(checkpoint["done_ids"])
+        for message_ids, page_token in iter_message_pages(service, query, page_token=checkpoint["page_token"]):
+            if page_token != checkpoint["page_token"]:
+                done_ids = set()
+            pending = [message_id for message_id in message_ids if message_id not in done_ids]
+            for start in range(0, len(pending), batch_size):
+                batch = pending[start:start + batch_size]
+                # Zprávy smazané mezi list a get se přeskočí, ale zapíší do done_ids,
+                # aby je navázaný export nezkoušel znovu
+                messages = fetch_messages(creds, service, batch, workers=workers, skip_missing=True, **fetch_kwargs)
+                writer.write(messages)
+                done_ids.update(batch)
+                session_exported += len(messages)
+                checkpoint.save(
+                    page_token=page_token,
+                    done_ids=sorted(done_ids),
+                    exported=checkpoint["exported"] + len(messages),
+                    **writer.checkpoint_state(),
+                )
+                rate = session_exported / max(time.monotonic() - started, 1e-9)
+                log(f"Exportováno {checkpoint['exported']} zpráv ({rate:.1f} zpráv/s).", log_level)
+        checkpoint.save(complete=True)
+    finally:
+        writer.close()
+
+    elapsed = time.monotonic() - started
+    log(
+        f"Export dokončen: {checkpoint['exported']} zpráv, v tomto běhu {session_exported} "
+        f"za {elapsed:.1f} s ({session_exported / max(elapsed, 1e-9):.1f} zpráv/s).",
+        log_level,
+    )
+    return checkpoint["exported"]
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Export Gmail zpráv do mbox / Parquet s navazováním.")
+    parser.add_argument("query", help="Gmail query, např. 'from:someone after:2024/01/01' ('' = vše)")
+    parser.add_argument("output", help="Cílový mbox soubor nebo adresář pro Parquet")
+    parser.add_argument("--format", choices=["mbox", "parquet"], default="mbox")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=None, help="Počet vláken pro stahování")
+    parser.add_argument("--force", action="store_true", help="Přepsat existující výstup bez checkpointu")
+    args = parser.parse_args()
+    export_messages(
+        args.query, args.output, fmt=args.format, batch_size=args.batch_size, workers=args.workers, force=args.force
+    )
@@ -0,0 +1,217 @@
+"""
+Volitelný lokální sémantický index nad e-maily (předmět, úryvek, tělo).
+Embeddingy počítá CPU model ze sentence-transformers, vyhledávání běží
+přes HNSW graf z knihovny hnswlib (approximate nearest neighbours).
+
+Instalace: pip install sentence-transformers hnswlib
+"""
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+from googleapiclient.errors import HttpError
+from gmail_auth import get_gmail_credentials, build_gmail_service
+from gmail_client import log, fetch_messages, get_plain_text_body, iter_message_pages
+
+try:
+    import hnswlib
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    hnswlib = None
+    SentenceTransformer = None
+
+# Vícejazyčný model (čeština), 384 dimenzí, na CPU jednotky ms na dotaz
+DEFAULT_MODEL = "paraphrase-multilingual-MiniLM-L12-v2"
+DEFAULT_INDEX_DIR = Path(__file__).parent / "semantic_index"
+# Delší texty model stejně ořízne, zbytečně je nekódujeme celé
+MAX_TEXT_CHARS = 2000
+# Počet zpráv stahovaných a kódovaných najednou při synchronizaci
+SYNC_BATCH_SIZE = 100
+# Uložení přepisuje celý index, při synchronizaci se proto ukládá nejvýš jednou za tolik sekund (a na konci)
+SYNC_SAVE_INTERVAL = 300
+
+class SemanticIndex:
+    """HNSW index embeddingů zpráv s inkrementálním přidáváním a ukládáním na disk.
+    Args:
+        index_dir: Adresář s index.bin a messages.json
+        model_name: Název sentence-transformers modelu
+    """
+    def __init__(self, index_dir, model_name=DEFAULT_MODEL):
+        if hnswlib is None:
+            raise ImportError("Sémantický index vyžaduje: pip install sentence-transformers hnswlib")
+        self.index_dir = Path(index_dir)
+        self.model = SentenceTransformer(model_name, device="cpu")
+        self.dim = self.model.get_sentence_embedding_dimension()
+        self._lock = threading.Lock()
+        # Souběžná přidávání se řadí za sebe, aby stejné ID nedostalo dva labely;
+        # kódování textů tak nedrží _lock a vyhledávání během něj běží dál
+        self._add_lock = threading.Lock()
+        # Label v HNSW = pozice v self.messages ([id, předmět])
+        self.messages = []
+        self._ids = set()
+
+        self.index = hnswlib.Index(space="cosine", dim=self.dim)
+        index_path = self.index_dir / "index.bin"
+        meta_path = self.index_dir / "messages.json"
+        if index_path.exists() and meta_path.exists():
+            with open(meta_path, encoding="utf-8") as f:
+                self.messages = json.load(f)
+            self.index.load_index(str(index_path), max_elements=max(1024, len(self.messages)))
+            if self.index.get_current_count() == len(self.messages):
+                self._ids = {message_id for message_id, _ in self.messages}
+                log(f"Načten sémantický index ({len(self.messages)} zpráv).")
+            else:
+                # Ukládání přerušené mezi přepsáním index.bin a messages.json, labely by neseděly
+                log(
+                    f"Sémantický index ({self.index.get_current_count()} prvků) nesouhlasí s messages.json "
+                    f"({len(self.messages)} zpráv), vytvářím ho znovu.",
+                    logging.WARNING,
+                )
+                self.messages = []
+                self.index = hnswlib.Index(space="cosine", dim=self.dim)
+                self.index.init_index(max_elements=1024, ef_construction=200, M=16)
+        else:
+            self.index.init_index(max_elements=1024, ef_construction=200, M=16)
+        self.index.set_ef(64)
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __contains__(self, message_id):
+        return message_id in self._ids
+
+    def _encode(self, texts):
+        return self.model.encode(texts, batch_size=32, normalize_embeddings=True, convert_to_numpy=True)
+
+    def add(self, items):
+        """Přidá zprávy do indexu, již zaindexovaná ID přeskočí.
+        Args:
+            items: Seznam trojic (id zprávy, předmět, text k zaindexování)
+        Returns:
+            Počet nově přidaných zpráv
+        """
+        with self._add_lock:
+            items = list({item[0]: item for item in items if item[0] not in self._ids}.values())
+            if not items:
+                return 0
+            vectors = self._encode([text[:MAX_TEXT_CHARS] for _, _, text in items])
+            with self._lock:
+                start = len(self.messages)
+                needed = start + len(items)
+                if needed > self.index.get_max_elements():
+                    self.index.resize_index(max(needed, 2 * self.index.get_max_elements()))
+                self.index.add_items(vectors, list(range(start, needed)))
+                for message_id, subject, _ in items:
+                    self.messages.append([message_id, subject])
+                    self._ids.add(message_id)
+            return len(items)
+
+    def search(self, query, k=5):
+        """Vrátí k nejpodobnějších zpráv jako seznam (id, předmět, skóre)."""
+        if not self.messages or k <= 0:
+            return []
+        vector = self._encode([query])
+        with self._lock:
+            k = min(k, len(self.messages))
+            labels, distances = self.index.knn_query(vector, k=k)
+        # Kosinová vzdálenost -> podobnost
+        return [
+            (self.messages[label][0], self.messages[label][1], float(1 - distance))
+            for label, distance in zip(labels[0], distances[0])
+        ]
+
+    def save(self):
+        """Uloží index (každý soubor atomicky přes os.replace, nesoulad po pádu mezi nimi pozná načtení)."""
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            self.index.save_index(str(self.index_dir / "index.bin.tmp"))
+            with open(self.index_dir / "messages.json.tmp", "w", encoding="utf-8") as f:
+                json.dump(self.messages, f, ensure_ascii=False)
+        os.replace(self.index_dir / "index.bin.tmp", self.index_dir / "index.bin")
+        os.replace(self.index_dir / "messages.json.tmp", self.index_dir / "messages.json")
+
+_index = None
+_index_lock = threading.Lock()
+
+def get_semantic_index():
+    """Vrátí sdílenou instanci indexu (model se načítá jen jednou)."""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = SemanticIndex(
+                os.getenv("GMAIL_INDEX_DIR_env", DEFAULT_INDEX_DIR),
+                os.getenv("GMAIL_SEMANTIC_MODEL_env", DEFAULT_MODEL),
+            )
+        return _index
+
+def _message_text(msg_detail):
+    headers = msg_detail.get("payload", {}).get("headers", [])
+    subject = next((h["value"] for h in headers if h["name"] == "Subject"), "")
+    text = "\n".join([subject, msg_detail.get("snippet", ""), get_plain_text_body(msg_detail)])
+    return subject, text
+
+def index_messages(msg_details, save=True):
+    """Přidá již stažené zprávy (formát 'full') do indexu a případně ho uloží."""
+    index = get_semantic_index()
+    items = []
+    for msg_detail in msg_details:
+        subject, text = _message_text(msg_detail)
+        items.append((msg_detail["id"], subject, text))
+    added = index.add(items)
+    if added and save:
+        index.save()
+    return added
+
+def sync_index(n=500, query='', log_level=logging.INFO):
+    """
+    Zaindexuje nejnovějších n zpráv odpovídajících query, které v indexu ještě nejsou.
+    Args:
+        n: Kolik nejnovějších zpráv projít
+        query: Gmail query pro omezení synchronizace
+    Returns:
+        Počet nově zaindexovaných zpráv
+    """
+    added = 0
+    try:
+        index = get_semantic_index()
+        creds = get_gmail_credentials(log_level)
+        service = build_gmail_service(creds)
+        pending = []
+        seen = 0
+        for message_ids, _ in iter_message_pages(service, query, page_size=min(n, 500)):
+            message_ids = message_ids[:n - seen]
+            seen += len(message_ids)
+            pending.extend(message_id for message_id in message_ids if message_id not in index)
+            if seen >= n:
+                break
+        unsaved = 0
+        last_save = time.monotonic()
+        try:
+            for start in range(0, len(pending), SYNC_BATCH_SIZE):
+                batch = pending[start:start + SYNC_BATCH_SIZE]
+                batch_added = index_messages(
+                    fetch_messages(creds, service, batch, skip_missing=True, format="full"), save=False
+                )
+                added += batch_added
+                unsaved += batch_added
+                if unsaved and time.monotonic() - last_save >= SYNC_SAVE_INTERVAL:
+                    index.save()
+                    unsaved = 0
+                    last_save = time.monotonic()
+        finally:
+            # Co se stihlo zaindexovat, se uloží i při chybě uprostřed synchronizace
+            if unsaved:
+                index.save()
+        log(f"Zaindexováno {added} nových zpráv (celkem {len(index)}).", log_level)
+        return added
+    except HttpError as error:
+        log(f'Chyba při synchronizaci sémantického indexu: {error}', logging.ERROR)
+        # Dávky zaindexované před chybou jsou v indexu (a uložené)
+        return added
+
+def semantic_search(query, k=5):
+    """Vrátí k nejpodobnějších zpráv jako seznam (id, předmět, skóre)."""
+    return get_semantic_index().search(query, k=k)
@@ -0,0 +1,111 @@
+"""
+Zátěžový test MCP serveru nad přehrávaným Gmail backendem (viz gmail_replay).
+Souběžně volá MCP nástroje přes in-memory fastmcp klienta a vypíše
+p50/p99 latenci a propustnost pro každý nástroj.
+
+Použití:
+    # 1. záznam skutečné komunikace
+    GMAIL_TRANSPORT_env=record python gmail_mcp.py   (nebo agent_test/agent.py)
+    # 2. zátěž nad záznamem
+    python gmail_loadtest.py --concurrency 50 --requests 2000 --latency-scale 0.5
+
+Bez --calls se volání odvodí z logu: list_emails s n podle zaznamenaných
+výpisů a get_email_detail na zaznamenaná ID zpráv. Soubor --calls je JSON
+seznam {"tool": ..., "arguments": {...}}, ze kterého se volání losují.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+from collections import defaultdict
+from urllib.parse import urlsplit, parse_qs
+
+# Režim přehrávání musí platit dřív, než se sestaví první Gmail service
+os.environ["GMAIL_TRANSPORT_env"] = "replay"
+
+from fastmcp import Client
+from gmail_replay import get_log_path, read_exchanges
+
+def calls_from_log(log_path):
+    """Odvodí typická volání nástrojů ze zaznamenaných požadavků."""
+    calls = []
+    for exchange in read_exchanges(log_path):
+        method, uri = exchange["key"].split(" ", 1)
+        parts = urlsplit(uri)
+        path = parts.path.rstrip("/")
+        if method != "GET" or exchange["status"] != 200:
+            continue
+        if path.endswith("/users/me/messages"):
+            query = parse_qs(parts.query)
+            # Jen výpisy bez filtru, ty list_emails umí zopakovat přesně
+            if "q" not in query or query["q"] == [""]:
+                calls.append({"tool": "list_emails", "arguments": {"n": int(query.get("maxResults", ["5"])[0])}})
+        elif "/users/me/messages/" in path and parse_qs(parts.query).get("format") == ["full"]:
+            calls.append({"tool": "get_email_detail", "arguments": {"message_id": path.rsplit("/", 1)[1]}})
+    return calls
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+async def run_load(calls, concurrency, total_requests):
+    """Provede total_requests náhodně vybraných volání s danou souběžností."""
+    # Import až teď: gmail_mcp při importu sestavuje moduly čtoucí ENV
+    from gmail_mcp import mcp
+
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async with Client(mcp) as client:
+        async def one_call(call):
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    await client.call_tool(call["tool"], call["arguments"])
+                except Exception:
+                    errors[call["tool"]] += 1
+                latencies[call["tool"]].append((time.perf_counter() - start) * 1000)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one_call(random.choice(calls)) for _ in range(total_requests)))
+        elapsed = time.perf_counter() - started
+    return latencies, errors, elapsed
+
+def print_report(latencies, errors, elapsed):
+    print(f"{'tool':<28}{'calls':>8}{'errors':>8}{'p50 ms':>10}{'p99 ms':>10}{'calls/s':>10}")
+    for tool in sorted(latencies):
+        values = latencies[tool]
+        print(
+            f"{tool:<28}{len(values):>8}{errors[tool]:>8}"
+            f"{percentile(values, 50):>10.1f}{percentile(values, 99):>10.1f}{len(values) / elapsed:>10.1f}"
+        )
+    total = sum(len(values) for values in latencies.values())
+    print(f"\nCelkem {total} volání za {elapsed:.2f} s ({total / elapsed:.1f} volání/s).")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Zátěžový test Gmail MCP serveru nad přehraným záznamem.")
+    parser.add_argument("--log", help="Log se záznamem (výchozí GMAIL_TRANSPORT_LOG_env)")
+    parser.add_argument("--calls", help="JSON soubor se seznamem volání {tool, arguments}")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="Násobek zaznamenané latence (0 = bez čekání)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.log:
+        os.environ["GMAIL_TRANSPORT_LOG_env"] = args.log
+    os.environ["GMAIL_REPLAY_LATENCY_SCALE_env"] = str(args.latency_scale)
+    random.seed(args.seed)
+
+    if args.calls:
+        with open(args.calls, encoding="utf-8") as f:
+            calls = json.load(f)
+    else:
+        calls = calls_from_log(get_log_path())
+    if not calls:
+        raise SystemExit("❌ Žádná volání k přehrání (prázdný log, nebo použijte --calls).")
+
+    print_report(*asyncio.run(run_load(calls, args.concurrency, args.requests)))
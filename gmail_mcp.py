@@ -5,12 +5,17 @@ from gmail_client import (
     get_message_detail, 
     get_messages_from_sender, 
     get_messages_by_subject, 
-    get_messages_by_body
+    get_messages_by_body,
+    prefetch_message_details,
+    get_prefetch_stats as get_prefetch_stats_client
 )
+from gmail_index import semantic_search, sync_index
+from gmail_profiling import PROFILE_ENABLED, traced_tool, span, get_slow_traces as get_slow_traces_profiling
 
 mcp = FastMCP("Gmail MCP")
 
 @mcp.tool
+@traced_tool
 def list_emails(
     n: int = 5,
     status: str = "all",
@@ -28,14 +33,17 @@ def list_emails(
     Pokud nejsou nalezeny žádné zprávy, vrátí 'No messages found.'.
     """
     messages = get_last_messages(n, status=status, after=after, before=before)
-    if not messages:
-        return "No messages found."
-    output = "Last emails:\n"
-    for msg in messages:
-        output += f"- {msg['subject']}\n"
-    return output
+    prefetch_message_details([msg["id"] for msg in messages])
+    with span("format"):
+        if not messages:
+            return "No messages found."
+        output = "Last emails:\n"
+        for msg in messages:
+            output += f"- {msg['subject']}\n"
+        return output
 
 @mcp.tool
+@traced_tool
 def list_emails_from_sender(
     sender_email: str,
     n: int = 5,
@@ -53,14 +61,17 @@ def list_emails_from_sender(
     Pokud nejsou nalezeny žádné zprávy, vrátí 'No messages found.'.
     """
     messages = get_messages_from_sender(sender_email, n=n, after=after, before=before)
-    if not messages:
-        return "No messages found."
-    output = f"Last emails from {sender_email}:\n"
-    for msg in messages:
-        output += f"- {msg['subject']}\n"
-    return output
+    prefetch_message_details([msg["id"] for msg in messages])
+    with span("format"):
+        if not messages:
+            return "No messages found."
+        output = f"Last emails from {sender_email}:\n"
+        for msg in messages:
+            output += f"- {msg['subject']}\n"
+        return output
 
 @mcp.tool
+@traced_tool
 def get_email_detail(message_id: str) -> str:
     """
     Získá detail konkrétního e-mailu podle jeho ID.
@@ -71,17 +82,19 @@ def get_email_detail(message_id: str) -> str:
     msg_detail = get_message_detail(message_id)
     if not msg_detail:
         return "Message not found."
-    headers = msg_detail.get("payload", {}).get("headers", [])
-    subject = next((h["value"] for h in headers if h["name"] == "Subject"), "(no subject)")
-    body = ""
-    parts = msg_detail.get("payload", {}).get("parts", [])
-    for part in parts:
-        if part.get("mimeType") == "text/plain":
-            body_data = part.get("body", {}).get("data", "")
-            body += body_data.encode('utf-8').decode('utf-8')
-    return f"Subject: {subject}\n\n{body}"
+    with span("format"):
+        headers = msg_detail.get("payload", {}).get("headers", [])
+        subject = next((h["value"] for h in headers if h["name"] == "Subject"), "(no subject)")
+        body = ""
+        parts = msg_detail.get("payload", {}).get("parts", [])
+        for part in parts:
+            if part.get("mimeType") == "text/plain":
+                body_data = part.get("body", {}).get("data", "")
+                body += body_data.encode('utf-8').decode('utf-8')
+        return f"Subject: {subject}\n\n{body}"
 
 @mcp.tool
+@traced_tool
 def send_mail(recipient: str, subject: str, body: str) -> str:
     """
     Odešle e-mail na zadanou adresu.
@@ -95,6 +108,7 @@ def send_mail(recipient: str, subject: str, body: str) -> str:
     return f"Email sent to {recipient} with subject '{subject}'."
 
 @mcp.tool
+@traced_tool
 def list_emails_by_subject(
     subject_text: str,
     n: int = 5,
@@ -112,14 +126,17 @@ def list_emails_by_subject(
     Pokud nejsou nalezeny žádné zprávy, vrátí 'No messages found.'.
     """
     messages = get_messages_by_subject(subject_text, n=n, after=after, before=before)
-    if not messages:
-        return "No messages found."
-    output = f"Last emails with subject containing '{subject_text}':\n"
-    for msg in messages:
-        output += f"- {msg['subject']}\n"
-    return output
+    prefetch_message_details([msg["id"] for msg in messages])
+    with span("format"):
+        if not messages:
+            return "No messages found."
+        output = f"Last emails with subject containing '{subject_text}':\n"
+        for msg in messages:
+            output += f"- {msg['subject']}\n"
+        return output
 
 @mcp.tool
+@traced_tool
 def list_emails_by_body(
     body_text: str,
     n: int = 5,
@@ -137,12 +154,80 @@ def list_emails_by_body(
     Pokud nejsou nalezeny žádné zprávy, vrátí 'No messages found.'.
     """
     messages = get_messages_by_body(body_text, n=n, after=after, before=before)
-    if not messages:
+    prefetch_message_details([msg["id"] for msg in messages])
+    with span("format"):
+        if not messages:
+            return "No messages found."
+        output = f"Last emails with body containing '{body_text}':\n"
+        for msg in messages:
+            output += f"- {msg['subject']}\n"
+        return output
+
+@mcp.tool
+@traced_tool
+def semantic_search_emails(query: str, k: int = 5) -> str:
+    """
+    Sémantické vyhledávání v lokálně zaindexovaných e-mailech (podle významu, ne klíčových slov),
+    např. 'e-maily o schůzce k projektu AI Asistent'. Index je třeba naplnit nástrojem sync_semantic_index.
+    Vstup:
+        query (str) – dotaz v přirozeném jazyce,
+        k (int, volitelné) – počet výsledků (výchozí 5)
+    Výstup: Textový seznam ID zpráv se skóre podobnosti (0–1) a předmětem.
+    Pokud nejsou nalezeny žádné zprávy, vrátí 'No messages found.'.
+    """
+    try:
+        results = semantic_search(query, k=k)
+    except ImportError as e:
+        return str(e)
+    prefetch_message_details([message_id for message_id, _, _ in results])
+    if not results:
         return "No messages found."
-    output = f"Last emails with body containing '{body_text}':\n"
-    for msg in messages:
-        output += f"- {msg['subject']}\n"
+    output = f"Emails semantically closest to '{query}':\n"
+    for message_id, subject, score in results:
+        output += f"- {message_id} (score {score:.3f}): {subject}\n"
     return output
 
+@mcp.tool
+@traced_tool
+def sync_semantic_index(n: int = 500, query: str = "") -> str:
+    """
+    Přidá do lokálního sémantického indexu nejnovějších n e-mailů, které v něm ještě nejsou.
+    Vstup:
+        n (int, volitelné) – kolik nejnovějších zpráv projít (výchozí 500),
+        query (str, volitelné) – Gmail query pro omezení zpráv
+    Výstup: Počet nově zaindexovaných zpráv.
+    """
+    try:
+        added = sync_index(n=n, query=query)
+    except ImportError as e:
+        return str(e)
+    return f"Indexed {added} new messages."
+
+@mcp.tool
+def get_slow_traces(limit: int = 5) -> str:
+    """
+    Vrátí časové osy posledních pomalých volání nástrojů (auth, discovery.build, HTTP volání
+    Gmail API, čekání na kvótu, formátování). Funguje jen se zapnutým GMAIL_PROFILE_env=1.
+    Vstup: limit (int, volitelné) – počet vrácených volání (výchozí 5).
+    Výstup: Textový výpis trace, nejnovější první.
+    """
+    if not PROFILE_ENABLED:
+        return "Profiling is disabled (set GMAIL_PROFILE_env=1)."
+    traces = get_slow_traces_profiling(limit)
+    if not traces:
+        return "No slow calls recorded."
+    return "\n\n".join(trace.to_text() for trace in traces)
+
+@mcp.tool
+def get_prefetch_stats() -> str:
+    """
+    Vrátí statistiky cache detailů zpráv a read-ahead (GMAIL_PREFETCH_K_env): kolik zpráv
+    bylo staženo dopředu, kolik z nich agent skutečně otevřel (prefetch_hit_rate), kolik
+    prefetchů bylo zrušeno nebo přeskočeno kvůli paměti či kvótě.
+    Výstup: Textový výpis statistik, každá na novém řádku.
+    """
+    stats = get_prefetch_stats_client()
+    return "\n".join(f"{key}: {value:.3f}" if isinstance(value, float) else f"{key}: {value}" for key, value in stats.items())
+
 if __name__ == "__main__":
     mcp.run()
\ No newline at end of file
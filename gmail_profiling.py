@@ -0,0 +1,161 @@
+"""
+Volitelné profilování volání MCP nástrojů.
+Při GMAIL_PROFILE_env=1 se pro každé volání nástroje zaznamená časová osa
+úseků (autentizace, discovery.build, jednotlivá HTTP volání Gmail API,
+čekání na kvótu, formátování výstupu). Pomalá volání se drží v paměti
+a vrací je MCP nástroj get_slow_traces. Vybraný vzorek volání lze navíc
+profilovat přes cProfile nebo pyinstrument.
+
+| Proměnná                   | Výchozí    | Popis                                        |
+| GMAIL_PROFILE_env          | 0          | Zapne profilování                            |
+| GMAIL_PROFILE_SLOW_MS_env  | 1000       | Od kolika ms se volání považuje za pomalé    |
+| GMAIL_PROFILE_SAMPLE_env   | 0          | Podíl volání (0–1) profilovaných profilerem  |
+| GMAIL_PROFILER_env         | cprofile   | 'cprofile' nebo 'pyinstrument'               |
+"""
+import contextvars
+import cProfile
+import functools
+import io
+import os
+import pstats
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from googleapiclient.http import HttpRequest
+
+from gmail_config import env_number
+
+PROFILE_ENABLED = os.getenv("GMAIL_PROFILE_env", "0").lower() in ("1", "true", "yes")
+SLOW_THRESHOLD_MS = env_number("GMAIL_PROFILE_SLOW_MS_env", 1000.0, float)
+PROFILE_SAMPLE_RATE = env_number("GMAIL_PROFILE_SAMPLE_env", 0.0, float)
+PROFILER = os.getenv("GMAIL_PROFILER_env", "cprofile").lower()
+# Kolik posledních pomalých volání držet v paměti
+MAX_SLOW_TRACES = 50
+# Kolik řádků výstupu cProfile uložit k trace
+PROFILE_TOP_FUNCTIONS = 30
+# Argumenty nástrojů, jejichž hodnoty se do trace nezapisují (obsah a příjemci e-mailů)
+REDACTED_ARGUMENTS = {"body", "recipient", "message_text", "to"}
+# Ostatní hodnoty argumentů se v trace zkrátí na tolik znaků
+MAX_ARGUMENT_CHARS = 60
+
+def _redact_arguments(arguments):
+    # Trace vrací get_slow_traces libovolnému MCP klientovi, nesmí obsahovat obsah e-mailů
+    redacted = {}
+    for name, value in arguments.items():
+        if name in REDACTED_ARGUMENTS and value is not None:
+            redacted[name] = f"<redacted, {len(str(value))} chars>"
+        elif isinstance(value, str) and len(value) > MAX_ARGUMENT_CHARS:
+            redacted[name] = value[:MAX_ARGUMENT_CHARS] + "…"
+        else:
+            redacted[name] = value
+    return redacted
+
+_current_trace = contextvars.ContextVar("gmail_trace", default=None)
+_slow_traces = deque(maxlen=MAX_SLOW_TRACES)
+
+class Trace:
+    """Časová osa jednoho volání MCP nástroje."""
+    def __init__(self, tool, arguments):
+        self.tool = tool
+        self.arguments = _redact_arguments(arguments)
+        self.started_at = time.time()
+        self.duration_ms = None
+        self.profile = None
+        self.spans = []
+        self._t0 = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add_span(self, name, start, end):
+        # Úseky mohou přicházet i z vláken ThreadPoolExecutoru
+        with self._lock:
+            self.spans.append((name, (start - self._t0) * 1000, (end - start) * 1000, threading.current_thread().name))
+
+    def finish(self):
+        self.duration_ms = (time.perf_counter() - self._t0) * 1000
+
+    def to_text(self):
+        started = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.started_at))
+        lines = [f"{self.tool} {self.duration_ms:.1f} ms ({started}) args={self.arguments}"]
+        for name, offset, duration, thread in sorted(self.spans, key=lambda s: s[1]):
+            lines.append(f"  {offset:9.1f} ms  +{duration:8.1f} ms  {name} [{thread}]")
+        if self.profile:
+            lines.append("  --- profile ---")
+            lines.append(self.profile)
+        return "\n".join(lines)
+
+def current_trace():
+    """Vrátí trace právě probíhajícího volání nebo None."""
+    return _current_trace.get()
+
+@contextmanager
+def span(name):
+    """Zaznamená úsek do aktuální trace (mimo profilované volání nic nedělá)."""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add_span(name, start, time.perf_counter())
+
+class TracedHttpRequest(HttpRequest):
+    """HttpRequest, který každé volání Gmail API zapíše jako úsek trace."""
+    def execute(self, *args, **kwargs):
+        with span(f"http {self.methodId or self.method}"):
+            return super().execute(*args, **kwargs)
+
+def _start_profiler():
+    if PROFILER == "pyinstrument":
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            return None
+        profiler = Profiler()
+        profiler.start()
+        return profiler
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # V tomto vlákně už běží jiný profiler
+        return None
+    return profiler
+
+def _stop_profiler(profiler):
+    if isinstance(profiler, cProfile.Profile):
+        profiler.disable()
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+        return out.getvalue()
+    profiler.stop()
+    return profiler.output_text()
+
+def traced_tool(fn):
+    """Dekorátor MCP nástroje: při GMAIL_PROFILE_env=1 zaznamená trace volání."""
+    if not PROFILE_ENABLED:
+        return fn
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        trace = Trace(fn.__name__, kwargs)
+        token = _current_trace.set(trace)
+        profiler = _start_profiler() if random.random() < PROFILE_SAMPLE_RATE else None
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            if profiler is not None:
+                trace.profile = _stop_profiler(profiler)
+            trace.finish()
+            _current_trace.reset(token)
+            if trace.duration_ms >= SLOW_THRESHOLD_MS:
+                _slow_traces.append(trace)
+    return wrapper
+
+def get_slow_traces(limit=5):
+    """Vrátí posledních limit pomalých trace, nejnovější první."""
+    return list(_slow_traces)[::-1][:limit]
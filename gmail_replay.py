@@ -0,0 +1,192 @@
+"""
+Záznam a přehrávání HTTP komunikace s Gmail API (pro zátěžové testy bez Googlu).
+
+GMAIL_TRANSPORT_env=record  – skutečná volání se navíc zapisují do logu
+GMAIL_TRANSPORT_env=replay  – odpovědi se přehrávají z logu, bez sítě a bez přihlášení
+
+Log je gzip s jedním JSON záznamem na řádek (GMAIL_TRANSPORT_LOG_env).
+Hlavička Authorization a tokeny/secrets v URL a tělech se do logu nezapisují.
+Obsah odpovědí (tedy i e-maily) se ukládá tak, jak přišel – log je třeba
+chránit stejně jako schránku samotnou.
+"""
+import atexit
+import base64
+import gzip
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+import httplib2
+
+from gmail_config import env_number
+
+DEFAULT_LOG_PATH = Path(__file__).parent / "gmail_exchanges.jsonl.gz"
+REDACTED = "REDACTED"
+# Parametry a klíče JSON, které se nikdy nezapisují
+SECRET_KEYS = {"access_token", "refresh_token", "client_secret", "id_token", "key"}
+# Autorizační kód OAuth se maže jen v URL a u token endpointu; v odpovědích Gmail API
+# je "code" číselný kód chyby, který má v záznamu zůstat
+AUTH_CODE_KEYS = SECRET_KEYS | {"code"}
+# Hlavičky odpovědi, které má smysl zachovat (zbytek jen zvětšuje log)
+KEPT_RESPONSE_HEADERS = {"status", "content-type"}
+
+def _redact_uri(uri):
+    parts = urlsplit(uri)
+    query = [(k, REDACTED if k in AUTH_CODE_KEYS else v) for k, v in parse_qsl(parts.query, keep_blank_values=True)]
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(query), parts.fragment))
+
+def _redact_json(value, secret_keys):
+    if isinstance(value, dict):
+        return {k: REDACTED if k in secret_keys else _redact_json(v, secret_keys) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_redact_json(v, secret_keys) for v in value]
+    return value
+
+def _is_token_endpoint(uri):
+    parts = urlsplit(uri)
+    return parts.netloc == "oauth2.googleapis.com" or parts.path.endswith("/token")
+
+def _redact_body(content, uri):
+    secret_keys = AUTH_CODE_KEYS if _is_token_endpoint(uri) else SECRET_KEYS
+    try:
+        return json.dumps(_redact_json(json.loads(content), secret_keys))
+    except (TypeError, ValueError):
+        return content
+
+def _request_key(method, uri):
+    # Tělo požadavku do klíče nepatří – při zátěžovém testu se liší (např. send)
+    return f"{method} {_redact_uri(uri)}"
+
+def _encode_content(content):
+    try:
+        return {"content": content.decode("utf-8")}
+    except UnicodeDecodeError:
+        return {"content_b64": base64.b64encode(content).decode("ascii")}
+
+def _decode_content(exchange):
+    if "content_b64" in exchange:
+        return base64.b64decode(exchange["content_b64"])
+    return exchange["content"].encode("utf-8")
+
+def read_exchanges(log_path):
+    """Načte záznamy z logu (toleruje neuzavřený konec gzipu po pádu procesu)."""
+    exchanges = []
+    with gzip.open(log_path, "rt", encoding="utf-8") as f:
+        try:
+            for line in f:
+                if line.strip():
+                    exchanges.append(json.loads(line))
+        except (EOFError, json.JSONDecodeError):
+            pass
+    return exchanges
+
+class RecordingHttp:
+    """Obal httplib2.Http, který každou výměnu zapíše do logu (bez secrets)."""
+    def __init__(self, http, log_path):
+        self._http = http
+        self._log = _get_log_writer(log_path)
+
+    def __getattr__(self, name):
+        return getattr(self._http, name)
+
+    def request(self, uri, method="GET", body=None, headers=None, *args, **kwargs):
+        start = time.perf_counter()
+        response, content = self._http.request(uri, method, body, headers, *args, **kwargs)
+        latency_ms = (time.perf_counter() - start) * 1000
+        exchange = {
+            "key": _request_key(method, uri),
+            "status": response.status,
+            "headers": {k: v for k, v in response.items() if k in KEPT_RESPONSE_HEADERS},
+            "latency_ms": round(latency_ms, 2),
+        }
+        exchange.update(_encode_content(content))
+        if "content" in exchange:
+            exchange["content"] = _redact_body(exchange["content"], uri)
+        self._log.write(exchange)
+        return response, content
+
+class _LogWriter:
+    def __init__(self, log_path):
+        # Append do gzipu vytvoří další member, gzip.open je přečte všechny
+        self._file = gzip.open(log_path, "at", encoding="utf-8")
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def write(self, exchange):
+        with self._lock:
+            self._file.write(json.dumps(exchange, ensure_ascii=False) + "\n")
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+_log_writers = {}
+_log_writers_lock = threading.Lock()
+
+def _get_log_writer(log_path):
+    # Všechna vlákna zapisují do jednoho souboru přes jeden writer
+    with _log_writers_lock:
+        key = str(Path(log_path).resolve())
+        if key not in _log_writers:
+            _log_writers[key] = _LogWriter(log_path)
+        return _log_writers[key]
+
+class ReplayHttp:
+    """
+    Náhrada httplib2.Http, která odpovídá ze zaznamenaného logu.
+    Stejné požadavky dostávají zaznamenané odpovědi postupně dokola.
+    Args:
+        log_path: Cesta k logu
+        latency_scale: Násobek zaznamenané latence (0 = odpovídat hned)
+    """
+    def __init__(self, log_path, latency_scale=1.0):
+        self.latency_scale = latency_scale
+        self.timeout = None
+        self._exchanges = defaultdict(list)
+        for exchange in read_exchanges(log_path):
+            self._exchanges[exchange["key"]].append(exchange)
+        self._cursors = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def request(self, uri, method="GET", body=None, headers=None, *args, **kwargs):
+        key = _request_key(method, uri)
+        with self._lock:
+            candidates = self._exchanges.get(key)
+            if candidates:
+                exchange = candidates[self._cursors[key] % len(candidates)]
+                self._cursors[key] += 1
+        if not candidates:
+            content = json.dumps({"error": {"code": 404, "message": f"Not recorded: {key}"}}).encode()
+            return httplib2.Response({"status": "404", "content-type": "application/json"}), content
+        if self.latency_scale > 0:
+            time.sleep(exchange["latency_ms"] * self.latency_scale / 1000)
+        response = httplib2.Response(dict(exchange["headers"], status=str(exchange["status"])))
+        return response, _decode_content(exchange)
+
+    def close(self):
+        pass
+
+_replay_http = None
+_replay_lock = threading.Lock()
+
+def get_transport_mode():
+    """Vrátí 'record', 'replay' nebo None podle GMAIL_TRANSPORT_env."""
+    mode = os.getenv("GMAIL_TRANSPORT_env", "").lower()
+    return mode if mode in ("record", "replay") else None
+
+def get_log_path():
+    return Path(os.getenv("GMAIL_TRANSPORT_LOG_env", DEFAULT_LOG_PATH))
+
+def get_replay_http():
+    """Sdílená ReplayHttp instance (je thread-safe, log se načítá jen jednou)."""
+    global _replay_http
+    with _replay_lock:
+        if _replay_http is None:
+            scale = env_number("GMAIL_REPLAY_LATENCY_SCALE_env", 1.0, float)
+            _replay_http = ReplayHttp(get_log_path(), latency_scale=scale)
+        return _replay_http